@@ -27,7 +27,8 @@ def aerosol_maps(path, pdf=None):
                 figure.add_map(aerosol_map, aerosol, i + 1)
 #           figure.display()
             if pdf is not None:
-                pdf.savefig(figure.figure)
+                figure.save(pdf)
+            figure.close()
 
 
 if __name__ == "__main__":
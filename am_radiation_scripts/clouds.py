@@ -15,7 +15,8 @@ def cloud_amount_maps(path, pdf=None):
             figure.add_map(cloud_map, name, i + 1, [0, 1])
 #       figure.display()
         if pdf is not None:
-            pdf.savefig(figure.figure)
+            figure.save(pdf)
+        figure.close()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,16 @@
-from collections import namedtuple, OrderedDict
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 from netCDF4 import Dataset
+from numpy import ma
 
 from .maps import Figure, global_mean, Map
-from .metrics import DerivedMetric, MetricsDataset
+from .metrics import DerivedMetric, MetricsDataset, time_average
 
 
 class Fluxes(MetricsDataset):
     # Helper dictionaries.
+    directions = {"down": "d", "up": "u"}
     regimes = {"longwave": "l", "shortwave": "s"}
     sky = {
         "all": "",
@@ -25,57 +28,157 @@ class Fluxes(MetricsDataset):
             self.toa = -1
             self.surface = 0
 
-    def flux(self, regime, direction, conditions, location=None):
-        directions = {"down": "d", "up": "u"}
-        flux = self.dataset.variables[f"r{self.regimes[regime]}{directions[direction]}{self.sky[conditions]}"]
-        if location is None:
-            return DerivedMetric(flux[...], flux.dimensions, flux.getncattr("units"))
-        dimensions = list(flux.dimensions)
-        if not self.is_vertical(dimensions[1]):
-            raise ValueError("The second slowest dimension must be a vertical dimension.")
-        data = flux[:, getattr(self, location), ...]
-        dimensions.remove(dimensions[1])
-        units = flux.getncattr("units")
-        return DerivedMetric(data, dimensions, units)
-
-    def flux_down(self, regime, conditions, location=None):
-        return self.flux(regime, "down", conditions, location)
-
-    def flux_up(self, regime, conditions, location=None):
-        return self.flux(regime, "up", conditions, location)
-
-    def toa_energy_balance(self, regime, conditions):
+        # Flux variables in the dataset, keyed by (regime, direction, conditions).
+        self._var_handles = {}
+        for regime, r in self.regimes.items():
+            for direction, d in self.directions.items():
+                for conditions, c in self.sky.items():
+                    name = f"r{r}{d}{c}"
+                    if name in self.dataset.variables:
+                        self._var_handles[(regime, direction, conditions)] = \
+                            self.dataset.variables[name]
+
+        # Flux arrays that have already been read from the dataset, keyed by
+        # (regime, direction, conditions, location).
+        self._flux_cache = {}
+
+    def _read_flux(self, regime, direction, conditions, location=None):
+        """Reads a flux variable from the dataset, reusing previously read arrays.
+
+        Args:
+            regime: Spectral regime (i.e., longwave or shortwave).
+            direction: Flux direction (i.e., down or up).
+            conditions: Sky conditions.
+            location: String vertical location (toa or surface).  If provided, only
+                      the toa and surface levels are read, and both are cached.
+
+        Returns:
+            Tuple of the numpy data array, dimension names and units.
+
+        Raises:
+            ValueError if a location is provided and the second slowest dimension
+            is not a vertical dimension.
+        """
+        key = (regime, direction, conditions, location)
+        if key not in self._flux_cache:
+            flux = self._var_handles[key[:3]]
+            self._set_chunk_cache(flux)
+            dimensions = list(flux.dimensions)
+            units = flux.getncattr("units")
+            if location is None:
+                self._flux_cache[key] = (flux[...], tuple(dimensions), units)
+            else:
+                if not self.is_vertical(dimensions[1]):
+                    raise ValueError("The second slowest dimension must be a vertical dimension.")
+                dimensions.remove(dimensions[1])
+                # Read the toa and surface levels together in a single request, since
+                # the metrics use both and chunks usually span all of the levels.
+                locations = {x: getattr(self, x) % flux.shape[1] for x in ["toa", "surface"]}
+                levels = sorted(set(locations.values()))
+                data = flux[:, levels, ...]
+                for name, level in locations.items():
+                    self._flux_cache[key[:3] + (name,)] = \
+                        (data[:, levels.index(level), ...], tuple(dimensions), units)
+        return self._flux_cache[key]
+
+    def _derived_metric(self, data, dimensions, units, average=False):
+        """Creates a DerivedMetric object, optionally averaging the data over time.
+
+        Args:
+            data: Numpy array or netCDF4 Variable object.
+            dimensions: Tuple of dimension names.
+            units: String units description.
+            average: If True, average the data over the time dimension.
+
+        Returns:
+            DerivedMetric object.
+        """
+        if not average:
+            return DerivedMetric(data[...], dimensions, units)
+        dimensions = list(dimensions)
+        data = time_average(data, self.time_axis(dimensions))
+        dimensions.remove(self.time.name)
+        return DerivedMetric(data, tuple(dimensions), units)
+
+    def flux(self, regime, direction, conditions, location=None, average=False):
+        return self._derived_metric(*self._read_flux(regime, direction, conditions, location),
+                                    average)
+
+    def flux_down(self, regime, conditions, location=None, average=False):
+        return self.flux(regime, "down", conditions, location, average)
+
+    def flux_up(self, regime, conditions, location=None, average=False):
+        return self.flux(regime, "up", conditions, location, average)
+
+    def toa_energy_balance(self, regime, conditions, average=False):
         """Calculates the difference between the energy entering and leaving the
            top of the atmosphere.
 
         Args:
             regime: Spectral regime (i.e., longwave or shortwave.
             conditions: Sky conditions.
+            average: If True, average over the time dimension.
         """
-        up = self.flux_up(regime, conditions, location="toa")
-        data = self.flux_down(regime, conditions, location="toa")[...] - up[...]
+        up = self.flux_up(regime, conditions, location="toa", average=average)
+        data = self.flux_down(regime, conditions, location="toa", average=average)[...] - up[...]
         return DerivedMetric(data, up.dimensions, up.units)
 
-    def atmospheric_divergence(self, regime, conditions):
+    def atmospheric_divergence(self, regime, conditions, average=False):
         """Calculates the difference between the energy entering and leaving the atmosphere.
 
         Args:
             regime: Spectral regime (i.e., longwave or shortwave.
             conditions: Sky conditions.
+            average: If True, average over the time dimension.
         """
-        surface_down = self.flux_down(regime, conditions, location="surface")
-        surface_up = self.flux_up(regime, conditions, location="surface")
-        toa_down = self.flux_down(regime, conditions, location="toa")
-        toa_up = self.flux_up(regime, conditions, location="toa")
+        surface_down = self.flux_down(regime, conditions, location="surface", average=average)
+        surface_up = self.flux_up(regime, conditions, location="surface", average=average)
+        toa_down = self.flux_down(regime, conditions, location="toa", average=average)
+        toa_up = self.flux_up(regime, conditions, location="toa", average=average)
         data = toa_down[...] + surface_up[...] - (toa_up[...] + surface_down[...])
         return DerivedMetric(data, toa_up.dimensions, toa_up.units)
 
-    def heating_rate(self, regime, conditions):
-        heating = self.dataset.variables[f"tntr{self.regimes[regime]}{self.sky[conditions]}"]
+    def heating_rate(self, regime, conditions, average=False):
+        heating = self.get_variable(f"tntr{self.regimes[regime]}{self.sky[conditions]}")
         units, factor = heating.getncattr("units"), 1
         if units == "K s-1":
             units, factor = "K day-1", 34*3600
-        return DerivedMetric(heating[...]*factor, heating.dimensions, units)
+        # Averaging is done on the variable itself, so that it is read chunk by chunk.
+        metric = self._derived_metric(heating, heating.dimensions, units, average)
+        metric.data = metric.data*factor
+        return metric
+
+    def quad_bundle(self, metric, regime, location=None, average=False):
+        """Calculates a metric for each of the cases in the case list.
+
+        Args:
+            metric: String name of a Fluxes method.
+            regime: Spectral regime (i.e., longwave or shortwave).
+            location: String vertical location for the metric (toa or surface).
+            average: If True, average each sky condition over the time dimension before
+                     the cases are formed, so that no full time series is stacked.
+
+        Returns:
+            DerivedMetric object containing the data for all of the cases, stacked
+            along a new slowest varying "case" dimension in case list order.
+        """
+        # Calculate the metric once for each sky condition, since the conditions
+        # appear multiple times in the case list.
+        values = {}
+        for case in case_list():
+            for conditions in [case.data, case.baseline]:
+                if conditions is not None and conditions not in values:
+                    args = [x for x in [regime, conditions, location] if x is not None]
+                    values[conditions] = getattr(self, metric)(*args, average=average)
+
+        data = []
+        for case in case_list():
+            if case.baseline is None:
+                data.append(values[case.data][...])
+            else:
+                data.append(values[case.data][...] - values[case.baseline][...])
+        value = values[case_list()[0].data]
+        return DerivedMetric(ma.stack(data), ("case", *value.dimensions), value.units)
 
 
 def case_list():
@@ -86,54 +189,30 @@ def case_list():
             Case("all", None, "All Sky")]
 
 
-def quad_maps(fluxes, metric, regime, title, location=None, pdf=None, map_method="lon_lat_map"):
-    """Create a figure containing (2 x 2) maps, where when the first three are summed
-       they produce the fourth.
+def case_maps(fluxes, metrics, label, title, pdf=None, map_method="lon_lat_map"):
+    """Create a figure containing (2 x 2) maps, one for each case in the case list.
 
     Args:
         fluxes: Fluxes object.
-        metric: String name of a Fluxes method.
-        regime: String describing the spectral range (longwave or shortwave).
+        metrics: DerivedMetric object containing all of the cases (see Fluxes.quad_bundle),
+                 either with or without a time dimension.
+        label: String used to name the metric for each case.
         title: String title for the figure.
-        location: String vertical location for the metric (toa or surface).
         pdf: PdfPages object to write the output to.
         map_method: String describing which type of maps to
                     create (lon_lat_map or zonal_mean_map).
-
-    Returns:
-        OrderedDict of DerivedMetric objects.
     """
-    figure = Figure(num_rows=2, num_columns=2, title=title)
-    output = OrderedDict()
-    for i, case in enumerate(case_list()):
-        name = f"{case.data} {metric.replace('_', ' ')}"
-        args = [x for x in [regime, case.data, location] if x is not None]
-        derived_metric = getattr(fluxes, metric)(*args)
-        if case.baseline is not None:
-            args = [x for x in [regime, case.baseline, location] if x is not None]
-            baseline = getattr(fluxes, metric)(*args)
-            derived_metric.data[...] -= baseline.data[...]
-        fluxes.add_metric(name, derived_metric)
-        map = getattr(fluxes, map_method)(name)
-        if isinstance(map, Map):
-            title = f"{case.title} [Mean: {global_mean(map.data, map.y_data):.2f}]"
-            figure.add_map(map=map, title=title, position=i + 1)
-        else:
-            title = f"{case.title}"
-            figure.add_line_plot(map, title=title, position=i + 1)
-        output[case.title] = derived_metric
-#   figure.display()
-    if pdf is not None:
-        pdf.savefig(figure.figure)
-    return output
+    cases = metrics
+    if fluxes.time.name in cases.dimensions:
+        # Average all of the cases over time at once, then split them up.
+        name = f"{label} cases"
+        fluxes.add_metric(name, cases)
+        cases = getattr(fluxes, name)
 
-def net_maps(fluxes, lw_metric, sw_metric, title, pdf=None, map_method="lon_lat_map"):
     figure = Figure(num_rows=2, num_columns=2, title=title)
     for i, case in enumerate(case_list()):
-        name = f"{case.data} net"
-        lw, sw = lw_metric[case.title], sw_metric[case.title]
-        derived_metric = DerivedMetric(lw[...] + sw[...], lw.dimensions, lw.units)
-        fluxes.add_metric(name, derived_metric)
+        name = f"{case.data} {label}"
+        setattr(fluxes, name, DerivedMetric(cases[i], cases.dimensions[1:], cases.units))
         map = getattr(fluxes, map_method)(name)
         if isinstance(map, Map):
             title = f"{case.title} [Mean: {global_mean(map.data, map.y_data):.2f}]"
@@ -143,42 +222,149 @@ def net_maps(fluxes, lw_metric, sw_metric, title, pdf=None, map_method="lon_lat_
             figure.add_line_plot(map, title=title, position=i + 1)
 #   figure.display()
     if pdf is not None:
-        pdf.savefig(figure.figure)
+        figure.save(pdf)
+    figure.close()
+
 
+def quad_maps(fluxes, metric, regime, title, location=None, pdf=None, map_method="lon_lat_map",
+              metrics=None):
+    """Create a figure containing (2 x 2) maps, where when the first three are summed
+       they produce the fourth.
+
+    Args:
+        fluxes: Fluxes object.
+        metric: String name of a Fluxes method.
+        regime: String describing the spectral range (longwave or shortwave).
+        title: String title for the figure.
+        location: String vertical location for the metric (toa or surface).
+        pdf: PdfPages object to write the output to.
+        map_method: String describing which type of maps to
+                    create (lon_lat_map or zonal_mean_map).
+        metrics: DerivedMetric object previously calculated for all of the cases (i.e.,
+                 the output of an earlier call) to plot instead of recalculating it.
+
+    Returns:
+        DerivedMetric object containing all of the cases.
+    """
+    if metrics is None:
+        metrics = fluxes.quad_bundle(metric, regime, location)
+    case_maps(fluxes, metrics, metric.replace("_", " "), title, pdf, map_method)
+    return metrics
+
+
+def net_maps(fluxes, lw_metric, sw_metric, title, pdf=None, map_method="lon_lat_map",
+             metrics=None):
+    """Create a figure containing (2 x 2) maps of the sum of the longwave and
+       shortwave metrics for each case.
+
+    Args:
+        fluxes: Fluxes object.
+        lw_metric: DerivedMetric object containing all of the longwave cases.
+        sw_metric: DerivedMetric object containing all of the shortwave cases.
+        title: String title for the figure.
+        pdf: PdfPages object to write the output to.
+        map_method: String describing which type of maps to
+                    create (lon_lat_map or zonal_mean_map).
+        metrics: DerivedMetric object previously calculated for all of the cases (i.e.,
+                 the output of an earlier call) to plot instead of recalculating it.
+
+    Returns:
+        DerivedMetric object containing all of the net cases.
+    """
+    if metrics is None:
+        metrics = DerivedMetric(lw_metric[...] + sw_metric[...], lw_metric.dimensions,
+                                lw_metric.units)
+    case_maps(fluxes, metrics, "net", title, pdf, map_method)
+    return metrics
+
+
+def calculate_quad_bundles(path, bundles):
+    """Calculates time averaged metrics for all of the cases in a separate worker process.
+
+    Args:
+        path: Path to the model dataset.
+        bundles: List of (metric, regime, location) tuples, where metric is the string
+                 name of a Fluxes method, regime is the spectral range (longwave or
+                 shortwave) and location is the vertical location (toa, surface or None).
+
+    Returns:
+        Dictionary mapping each input tuple to a time averaged DerivedMetric object
+        containing all of the cases.
+    """
+    with Dataset(path) as dataset:
+        fluxes = Fluxes(dataset)
+        return {x: fluxes.quad_bundle(*x, average=True) for x in bundles}
+
+
+def flux_figures(dataset, pdf=None, max_workers=2):
+    """Creates the flux figures.
+
+    Args:
+        dataset: Path to the model dataset.
+        pdf: PdfPages object to write the output to.
+        max_workers: Maximum number of processes used to calculate the metrics.  The
+                     work is split into four tasks, so more than four is not useful.
+    """
+    # Calculate the time averaged metrics in parallel.  The flux metrics of each
+    # spectral regime are calculated in the same task, so that they share that
+    # worker's flux reads.  The figures themselves are drawn in order afterwards.
+    bundles = [
+        [("flux_up", "longwave", "toa"), ("flux_down", "longwave", "surface"),
+         ("atmospheric_divergence", "longwave", None)],
+        [("flux_up", "shortwave", "toa"), ("flux_down", "shortwave", "surface"),
+         ("toa_energy_balance", "shortwave", None),
+         ("atmospheric_divergence", "shortwave", None)],
+        [("heating_rate", "longwave", None)],
+        [("heating_rate", "shortwave", None)],
+    ]
+    metrics = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(calculate_quad_bundles, dataset, x) for x in bundles]:
+            metrics.update(future.result())
 
-def flux_figures(dataset, pdf=None):
     with Dataset(dataset) as dataset:
         fluxes = Fluxes(dataset)
         lw_energy_balance = quad_maps(fluxes, "flux_up", "longwave",
-                                      "Out-going TOA Longwave Radiation", "toa", pdf)
+                                      "Out-going TOA Longwave Radiation", "toa", pdf,
+                                      metrics=metrics.pop(("flux_up", "longwave", "toa")))
         quad_maps(fluxes, "flux_down", "longwave",
-                  "Downard Surface Longwave Radiation", "surface", pdf)
+                  "Downard Surface Longwave Radiation", "surface", pdf,
+                  metrics=metrics.pop(("flux_down", "longwave", "surface")))
         quad_maps(fluxes, "flux_up", "shortwave",
-                  "Out-going TOA Shortwave Radiation", "toa", pdf)
+                  "Out-going TOA Shortwave Radiation", "toa", pdf,
+                  metrics=metrics.pop(("flux_up", "shortwave", "toa")))
         quad_maps(fluxes, "flux_down", "shortwave",
-                  "Downward Surface Shortwave Radiation", "surface", pdf)
+                  "Downward Surface Shortwave Radiation", "surface", pdf,
+                  metrics=metrics.pop(("flux_down", "shortwave", "surface")))
         sw_energy_balance = quad_maps(fluxes, "toa_energy_balance", "shortwave",
-                                      "TOA Shortwave Energy Balance", pdf=pdf)
+                                      "TOA Shortwave Energy Balance", pdf=pdf,
+                                      metrics=metrics.pop(("toa_energy_balance", "shortwave", None)))
         net_maps(fluxes, lw_energy_balance, sw_energy_balance, "TOA Energy Balance", pdf=pdf)
+        del lw_energy_balance, sw_energy_balance
         lw_divergence = quad_maps(fluxes, "atmospheric_divergence", "longwave",
-                                  "Longwave Atmospheric Divergence", pdf=pdf)
+                                  "Longwave Atmospheric Divergence", pdf=pdf,
+                                  metrics=metrics.pop(("atmospheric_divergence", "longwave", None)))
         sw_divergence = quad_maps(fluxes, "atmospheric_divergence", "shortwave",
-                                  "Shortwave Atmospheric Divergence", pdf=pdf)
+                                  "Shortwave Atmospheric Divergence", pdf=pdf,
+                                  metrics=metrics.pop(("atmospheric_divergence", "shortwave", None)))
         net_maps(fluxes, lw_divergence, sw_divergence, "Atmospheric Divergence", pdf=pdf)
+        del lw_divergence, sw_divergence
         lw_heating = quad_maps(fluxes, "heating_rate", "longwave", "Longwave Radiative Heating Rate",
-                               pdf=pdf, map_method="zonal_mean_map")
+                               pdf=pdf, map_method="zonal_mean_map",
+                               metrics=metrics.pop(("heating_rate", "longwave", None)))
         sw_heating = quad_maps(fluxes, "heating_rate", "shortwave", "Shortwave Radiative Heating Rate",
+                               pdf=pdf, map_method="zonal_mean_map",
+                               metrics=metrics.pop(("heating_rate", "shortwave", None)))
+        net_heating = net_maps(fluxes, lw_heating, sw_heating, "Atmospheric Heating Rate",
                                pdf=pdf, map_method="zonal_mean_map")
-        net_maps(fluxes, lw_heating, sw_heating, "Atmospheric Heating Rate",
-                 pdf=pdf, map_method="zonal_mean_map")
-        lw_heating = quad_maps(fluxes, "heating_rate", "longwave",
-                               "Global Mean Longwave Radiative Heating Rate",
-                               pdf=pdf, map_method="global_mean_vertical_plot")
-        sw_heating = quad_maps(fluxes, "heating_rate", "shortwave",
-                               "Global Mean Shortwave Radiative Heating Rate",
-                               pdf=pdf, map_method="global_mean_vertical_plot")
+        quad_maps(fluxes, "heating_rate", "longwave",
+                  "Global Mean Longwave Radiative Heating Rate",
+                  pdf=pdf, map_method="global_mean_vertical_plot", metrics=lw_heating)
+        quad_maps(fluxes, "heating_rate", "shortwave",
+                  "Global Mean Shortwave Radiative Heating Rate",
+                  pdf=pdf, map_method="global_mean_vertical_plot", metrics=sw_heating)
         net_maps(fluxes, lw_heating, sw_heating, "Global Mean Radiative Heating Rate",
-                 pdf=pdf, map_method="global_mean_vertical_plot")
+                 pdf=pdf, map_method="global_mean_vertical_plot", metrics=net_heating)
 
 
 if __name__ == "__main__":
@@ -1,34 +1,125 @@
 import cartopy.crs as ccrs
-from cartopy.util import add_cyclic
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
-from numpy import cos, linspace, mean, pi, sum, unravel_index
+from numpy import append, asarray, ascontiguousarray, cos, deg2rad, einsum, empty, ma, mean, ndarray, \
+                  sum, zeros
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
+
+def chunked_mean(data, axis):
+    """Performs a mean over a dimension.
+
+    netCDF4 Variable objects are read one chunk at a time along the dimension,
+    so that the full variable is never held in memory.
+
+    Args:
+        data: Data array or netCDF4 Variable object to perform the mean over.
+        axis: The index of the dimension.
+
+    Returns:
+        Numpy array of mean values.
+    """
+    if not hasattr(data, "chunking"):
+        return mean(data[...], axis=axis)
+    axis = axis % len(data.shape)
+    size = data.shape[axis]
+    chunking = data.chunking()
+    if chunking is None or chunking == "contiguous":
+        step = 1 if axis == 0 else size
+    else:
+        step = chunking[axis]
+    shape = data.shape[:axis] + data.shape[axis + 1:]
+    total = zeros(shape, dtype="float64")
+    count = zeros(shape, dtype="int64")
+    index = [slice(None)]*len(data.shape)
+    for i in range(0, size, step):
+        index[axis] = slice(i, i + step)
+        chunk = ma.asarray(data[tuple(index)])
+        total += ma.filled(chunk, 0).sum(axis=axis, dtype="float64")
+        count += ma.count(chunk, axis=axis)
+    return ma.divide(total, count)
 
 
 def zonal_mean(data, axis=-1):
     """Performs a mean over the longitude dimension.
 
     Args:
-        data: Data array to perform the mean over.
-        axis: The index of the latitude dimension.
+        data: Data array or netCDF4 Variable object to perform the mean over.
+        axis: The index of the longitude dimension.
 
     Returns:
         Numpy array of zonal mean values.
     """
-    return mean(data, axis=axis)
+    return chunked_mean(data, axis)
+
+
+def latitude_weights(latitude):
+    """Calculates the area weight of each latitude.
+
+    Args:
+        latitude: Numpy array of latitude values [degrees].
+
+    Returns:
+        Numpy array of weights.
+    """
+    return cos(deg2rad(latitude[...]))
 
 
-def global_mean(data, latitude):
+def _global_mean_kernel(data, weights):
+    """Performs a weighted mean over the last two dimensions in a single pass.
+
+    Args:
+        data: Three-dimensional (n, latitude, longitude) contiguous data array.
+        weights: Numpy array of latitude weights.
+
+    Returns:
+        Numpy array of n global mean values.
+    """
+    n, ny, nx = data.shape
+    norm = nx*weights.sum()
+    output = empty(n)
+    for i in prange(n):
+        total = 0.
+        for j in range(ny):
+            row = 0.
+            for k in range(nx):
+                row += data[i, j, k]
+            total += row*weights[j]
+        output[i] = total/norm
+    return output
+
+
+if njit is not None:
+    _global_mean_kernel = njit(parallel=True, cache=True)(_global_mean_kernel)
+
+
+def global_mean(data, latitude=None, weights=None):
     """Performs a global mean over the longitude and latitude dimensions.
 
     Args:
         data: Data array to perform the mean over.
         latitude: Numpy array of latitude values [degrees].
+        weights: Numpy array of latitude weights (see latitude_weights).  If
+                 provided, latitude is ignored.
 
     Returns:
         Numpy array of global mean values.
     """
-    weights = cos(2.*pi*latitude/360.)
-    return sum(zonal_mean(data)*weights, axis=-1)/sum(weights)
+    if weights is None:
+        weights = latitude_weights(latitude)
+    data = data[...]
+    if ma.is_masked(data):
+        return sum(zonal_mean(data)*weights, axis=-1)/sum(weights)
+    if njit is not None:
+        shape = data.shape[:-2]
+        data = ascontiguousarray(data).reshape((-1,) + data.shape[-2:])
+        return _global_mean_kernel(data, ascontiguousarray(weights)).reshape(shape)[()]
+    return einsum("...yx,y->...", data, weights)/(data.shape[-1]*sum(weights))
 
 
 class Map(object):
@@ -41,7 +132,12 @@ class Map(object):
 class LonLatMap(Map):
     def __init__(self, data, longitude, latitude, units=None,
                  projection=ccrs.PlateCarree(), coastlines=True):
-        self.data, self.x_data, self.y_data = add_cyclic(data[...], longitude[...], latitude[...])
+        # Repeat the first longitude so the map wraps around without a gap.
+        values = data[...]
+        self.data = ma.concatenate([values, values[..., :1]], axis=-1)
+        longitude = longitude[...]
+        self.x_data = append(longitude, longitude[0] + 360.)
+        self.y_data = latitude[...]
         self.projection = projection
         self.coastlines = coastlines
         self.xlabel = "Longitude"
@@ -51,7 +147,7 @@ class LonLatMap(Map):
 
 class ZonalMeanMap(Map):
     def __init__(self, data, latitude, y_data, units=None, ylabel=None, invert_y_axis=False):
-        self.data = zonal_mean(data[...])
+        self.data = zonal_mean(data)
         self.x_data = latitude[...]
         self.y_data = y_data[...]
         self.invert_y_axis = invert_y_axis
@@ -63,52 +159,70 @@ class ZonalMeanMap(Map):
 
 class LinePlot(object):
     def __init__(self, x_data, xlabel, data, ylabel):
-        self.x_data = x_data[...]
+        # Numpy arrays are used as is, other objects (i.e., netCDF4 Variables) are read.
+        self.x_data = x_data if isinstance(x_data, ndarray) else x_data[...]
         self.xlabel = xlabel
-        self.data = data[...]
+        self.data = data if isinstance(data, ndarray) else data[...]
         self.ylabel = ylabel
 
 
 class GlobalMeanVerticalPlot(LinePlot):
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, *kwargs)
+        super().__init__(*args, **kwargs)
         self.x_data, self.data = self.data, self.x_data
         self.xlabel, self.ylabel = self.ylabel, self.xlabel
         self.invert_y_axis = True
 
 
 class Figure(object):
-    def __init__(self, num_rows=1, num_columns=1, size=(16, 12), title=None):
+    def __init__(self, num_rows=1, num_columns=1, size=(16, 12), title=None, dpi=150):
         """Creates a figure for the input number of plots.
 
         Args:
             num_rows: Number of rows of plots.
             num_columns: Number of columns of plots.
+            dpi: Resolution of the rasterized map data.
         """
-        self.figure = plt.figure(figsize=size, layout="compressed")
+        self.figure = plt.figure(figsize=size, dpi=dpi, layout="compressed")
         if title is not None:
             self.figure.suptitle(title.title())
         self.num_rows = num_rows
         self.num_columns = num_columns
         self.plot = [[None for y in range(num_columns)] for x in range(num_rows)]
 
+        # Maps that share a colorbar range also share a single colorbar, which is
+        # drawn once all of them have been added.
+        self._pending_colorbar = None
+
     def add_map(self, map, title, position=1, colorbar_range=None):
         """Adds a Map object to the figure.
 
         Args:
             map: Map object.
             position: Position index for the plot in the figure.
+            colorbar_range: Minimum and maximum colorbar values.  Consecutive maps
+                            with the same range share a single colorbar.
         """
         plot = self.figure.add_subplot(self.num_rows, self.num_columns,
                                        position, projection=map.projection)
+        # Draw the data as a rasterized mesh, since the thousands of polygons
+        # produced by a filled contour plot are very slow to write to a pdf.
+        kwargs = {"shading": "auto", "rasterized": True}
+        if colorbar_range is not None:
+            kwargs["vmin"], kwargs["vmax"] = colorbar_range
+        if map.projection is not None:
+            kwargs["transform"] = map.projection
+        cs = plot.pcolormesh(map.x_data, map.y_data, map.data, **kwargs)
+#       plot.colorbar(cs, label=map.data_label, fraction=0.46, pad=0.04)
         if colorbar_range is None:
-            levels = 60
+            self.figure.colorbar(cs, ax=plot, label=map.data_label)
         else:
-            levels = linspace(colorbar_range[0], colorbar_range[1], 60)
-        cs = plot.contourf(map.x_data, map.y_data, map.data, levels=levels,
-                           transform=map.projection)
-#       plot.colorbar(cs, label=map.data_label, fraction=0.46, pad=0.04)
-        self.figure.colorbar(cs, ax=plot, label=map.data_label)
+            key = (tuple(colorbar_range), map.data_label)
+            if self._pending_colorbar is not None and self._pending_colorbar[0] != key:
+                self._draw_pending_colorbar()
+            if self._pending_colorbar is None:
+                self._pending_colorbar = (key, cs, [])
+            self._pending_colorbar[2].append(plot)
         if isinstance(map, LonLatMap):
             plot.coastlines()
             grid = plot.gridlines(draw_labels=True, dms=True)
@@ -138,10 +252,32 @@ class Figure(object):
         x, y = self.plot_position_to_indices(position)
         self.plot[x][y] = plot
 
+    def save(self, pdf):
+        """Writes the figure to a pdf.
+
+        Args:
+            pdf: PdfPages object to write the figure to.
+        """
+        self._draw_pending_colorbar()
+        pdf.savefig(self.figure)
+
+    def close(self):
+        """Closes the figure, releasing it and all of its plots."""
+        plt.close(self.figure)
+
     def display(self):
 #       self.figure.colorbar(self.cs)
+        self._draw_pending_colorbar()
         plt.show()
 
+    def _draw_pending_colorbar(self):
+        """Draws the colorbar shared by the most recently added maps."""
+        if self._pending_colorbar is None:
+            return
+        (_, label), cs, plots = self._pending_colorbar
+        self.figure.colorbar(cs, ax=plots, label=label, shrink=0.8)
+        self._pending_colorbar = None
+
     def plot_position_to_indices(self, position):
         """Converts from a plot position to its x and y indices.
 
@@ -151,4 +287,49 @@ class Figure(object):
         Returns:
             The x and y indices for the plot.
         """
-        return unravel_index(position - 1, (self.num_rows, self.num_columns))
+        return divmod(position - 1, self.num_columns)
+
+
+class RasterPdfPages(PdfPages):
+    """Multi-page pdf file where each figure is written as a single image.
+
+    Each figure is rendered with the Agg backend and only the resulting image is
+    written to the pdf, which avoids the cost of writing every artist with the
+    pdf backend.
+    """
+    def __init__(self, *args, dpi=200, **kwargs):
+        """Opens the pdf file.
+
+        Args:
+            dpi: Resolution of the page images.
+        """
+        super().__init__(*args, **kwargs)
+        self.dpi = dpi
+
+    def savefig(self, figure=None, **kwargs):
+        """Writes a figure to the pdf as an image.
+
+        Args:
+            figure: matplotlib Figure object or figure number.  Defaults to the
+                    current figure.
+        """
+        if figure is None:
+            figure = plt.gcf()
+        elif isinstance(figure, int):
+            figure = plt.figure(figure)
+        canvas = figure.canvas
+        if not hasattr(canvas, "buffer_rgba"):
+            canvas = FigureCanvasAgg(figure)
+        dpi = figure.dpi
+        figure.set_dpi(self.dpi)
+        try:
+            canvas.draw()
+            image = asarray(canvas.buffer_rgba())
+            page = plt.figure(figsize=figure.get_size_inches(), dpi=self.dpi)
+        finally:
+            figure.set_dpi(dpi)
+        plot = page.add_axes([0, 0, 1, 1])
+        plot.imshow(image, aspect="auto", interpolation="none")
+        plot.set_axis_off()
+        super().savefig(page, **kwargs)
+        plt.close(page)
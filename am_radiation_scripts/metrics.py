@@ -1,6 +1,7 @@
-from numpy import mean
+from math import ceil, prod
 
-from .maps import global_mean, GlobalMeanVerticalPlot, LonLatMap, ZonalMeanMap
+from .maps import chunked_mean, global_mean, GlobalMeanVerticalPlot, latitude_weights, \
+                  LonLatMap, ZonalMeanMap
 
 
 def grid(dataset, axis):
@@ -23,6 +24,19 @@ def grid(dataset, axis):
     return dims
 
 
+def time_average(data, axis):
+    """Averages data over the time dimension.
+
+    Args:
+        data: netCDF4 Variable or DerivedMetric object.
+        axis: The index of the time dimension.
+
+    Returns:
+        Numpy array of time averaged values.
+    """
+    return chunked_mean(data, axis)
+
+
 class DerivedMetric(object):
     """Helper class to calculate metrics.
 
@@ -47,17 +61,38 @@ class MetricsDataset(object):
     """Calculates metric maps and plots from model output datasets.
 
     Attributes:
+        chunk_cache_size: Maximum size [bytes] of the chunk cache of each chunked
+                          variable that is read.
         dataset: netCDF4 Dataset object.
         latitude: netCDF4 Variable object for the latitude dimension.
+        latitude_weights: Numpy array of area weights for each latitude.
         longitude: netCDF4 Variable object for the longitude dimension.
         time: netCDF4 Variable object for the time dimension.
         vertical: List of netCDF Variable objects for the vertical dimensions.
     """
-    def __init__(self, dataset):
+    def __init__(self, dataset, chunk_cache_size=256*1024*1024):
+        """Initializes the object.
+
+        Args:
+            dataset: netCDF4 Dataset object.
+            chunk_cache_size: Maximum size [bytes] of the chunk cache of each
+                              chunked variable that is read.
+        """
         self.dataset = dataset
+        self.chunk_cache_size = chunk_cache_size
+        self._chunk_cache_set = set()
+
+        # Query the metadata of every variable once up front (__dict__ returns all
+        # of a variable's attributes in a single call).  Variables without units
+        # are marked with None.
+        self._metadata = {}
+        for name, variable in dataset.variables.items():
+            self._metadata[name] = (variable.dimensions, variable.__dict__.get("units"))
+        self._time_axes = {}
         self.time = grid(dataset, "t")[0]
         self.longitude = grid(dataset, "x")[0]
         self.latitude = grid(dataset, "y")[0]
+        self.latitude_weights = latitude_weights(self.latitude)
         try:
             self.vertical = grid(dataset, "z")
         except ValueError:
@@ -79,22 +114,26 @@ class MetricsDataset(object):
             invalid time_method value is used.
         """
         if isinstance(variable, str):
-            data = self.dataset.variables[variable]
+            data = self.get_variable(variable)
+            dimensions, units = self._metadata[variable]
+            if units is None:
+                # Raises the same AttributeError as reading the missing attribute.
+                units = data.getncattr("units")
         else:
             data = variable
-        dimensions = list(data.dimensions)
-        units = data.getncattr("units")
+            dimensions, units = data.dimensions, data.getncattr("units")
+        dimensions = list(dimensions)
 
         if time_method == "average":
-            data = mean(data[...], axis=dimensions.index(self.time.name))
+            data = time_average(data, self.time_axis(dimensions))
             dimensions.remove(self.time.name)
         elif time_method == "instantaneous":
-            if dimensions.index(self.time.name) != 0:
+            if self.time_axis(dimensions) != 0:
                 raise ValueError("time must be the slowest varying dimension.")
             data = data[time_index, ...]
             dimensions.remove(self.time.name)
         elif time_method == "time series":
-            data = global_mean(data, self.latitude)
+            data = global_mean(data, weights=self.latitude_weights)
             dimensions = tuple(x for x in dimensions if not
                                (x == self.longitude.name or x == self.latitude.name))
         else:
@@ -102,6 +141,55 @@ class MetricsDataset(object):
 
         setattr(self, metric_name, DerivedMetric(data, tuple(dimensions), units))
 
+    def get_variable(self, name):
+        """Gets a variable from the dataset, preparing it to be read.
+
+        Args:
+            name: String name of the variable.
+
+        Returns:
+            netCDF4 Variable object.
+        """
+        variable = self.dataset.variables[name]
+        self._set_chunk_cache(variable)
+        return variable
+
+    def _set_chunk_cache(self, variable):
+        """Sizes a chunked variable's chunk cache to hold one slab of chunks along its
+           slowest varying dimension (i.e., a full field for one chunk of time records),
+           so that no chunk is decompressed more than once while the slab is read.
+
+        Args:
+            variable: netCDF4 Variable object.
+        """
+        if variable.name in self._chunk_cache_set:
+            return
+        self._chunk_cache_set.add(variable.name)
+        chunking = variable.chunking()
+        if chunking is None or chunking == "contiguous":
+            return
+        num_chunks = prod(ceil(n/c) for n, c in zip(variable.shape[1:], chunking[1:]))
+        size = variable.dtype.itemsize*prod(chunking)*num_chunks
+        variable.set_var_chunk_cache(size=min(size, self.chunk_cache_size),
+                                     nelems=max(1009, 10*num_chunks))
+
+    def time_axis(self, dimensions):
+        """Finds the index of the time dimension.
+
+        Args:
+            dimensions: List of dimension names.
+
+        Returns:
+            Index of the time dimension.
+
+        Raises:
+            ValueError if the time dimension is not found.
+        """
+        key = tuple(dimensions)
+        if key not in self._time_axes:
+            self._time_axes[key] = key.index(self.time.name)
+        return self._time_axes[key]
+
     def find_vertical(self, name):
         """Finds a vertical dimension in the dataset by name.
 
@@ -191,6 +279,6 @@ class MetricsDataset(object):
            metric.dimensions[-2:] == (self.latitude.name, self.longitude.name):
             y = self.find_vertical(metric.dimensions[0])
             return GlobalMeanVerticalPlot(y, y.getncattr("units"),
-                                          global_mean(metric.data[...], self.latitude[...]),
+                                          global_mean(metric.data, weights=self.latitude_weights),
                                           metric.getncattr("units"))
         raise ValueError("Invalid dimensions for a global mean line plot.")
@@ -1,30 +1,56 @@
 from argparse import ArgumentParser
 from os import listdir
 from os.path import join
-from re import escape, match
+import re
 
+import matplotlib
 from matplotlib.backends.backend_pdf import PdfPages
 
 from am_radiation_scripts import aerosol_maps, cloud_amount_maps, flux_figures
+from am_radiation_scripts.maps import RasterPdfPages
 
 
-def find_dataset(name, directory):
+def find_datasets(names, directory):
+    """Finds the dataset file for each name in a single pass over the directory.
+
+    Args:
+        names: List of dataset names (i.e., rad_fluxes).
+        directory: Path to the input data directory.
+
+    Returns:
+        Dictionary mapping each name to the path of its dataset.
+
+    Raises:
+        ValueError if a dataset cannot be found.
+    """
+    patterns = {name: re.compile(r"[0-9]+\." + re.escape(name) + r"\.nc") for name in names}
+    paths = {}
     for filename in listdir(directory):
-        if match(r"[0-9]+\." + escape(name) + r"\.nc", filename):
-            return join(directory, filename)
-    raise ValueError(f"could not find file associated with {name}.")
+        for name, pattern in patterns.items():
+            if name not in paths and pattern.match(filename):
+                paths[name] = join(directory, filename)
+    for name in names:
+        if name not in paths:
+            raise ValueError(f"could not find file associated with {name}.")
+    return paths
 
 
 def main():
     parser = ArgumentParser(description="Radiation analysis report.")
     parser.add_argument("directory", help="Path to input data directory")
     parser.add_argument("output", help="Name of output pdf", default="out.pdf")
+    parser.add_argument("--vector", action="store_true",
+                        help="Write vector pdf pages instead of rasterized ones")
     args = parser.parse_args()
 
-    with PdfPages(args.output) as pdf:
-        flux_figures(find_dataset("rad_fluxes", args.directory), pdf=pdf)
-        cloud_amount_maps(find_dataset("rad_clouds", args.directory), pdf=pdf)
-        aerosol_maps(find_dataset("rad_aerosol", args.directory), pdf)
+    # The figures are only written to the pdf, so an interactive backend is not needed.
+    matplotlib.use("Agg")
+    paths = find_datasets(["rad_fluxes", "rad_clouds", "rad_aerosol"], args.directory)
+    pdf_pages = PdfPages if args.vector else RasterPdfPages
+    with pdf_pages(args.output) as pdf:
+        flux_figures(paths["rad_fluxes"], pdf=pdf)
+        cloud_amount_maps(paths["rad_clouds"], pdf=pdf)
+        aerosol_maps(paths["rad_aerosol"], pdf)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+from netCDF4 import Dataset
+from numpy import arange, float32, linspace, ma, mean, sum
+from numpy.random import default_rng
+from numpy.testing import assert_allclose
+import pytest
+
+from am_radiation_scripts import maps
+from am_radiation_scripts.maps import chunked_mean, global_mean, latitude_weights, zonal_mean
+
+
+@pytest.fixture
+def chunked_variable(tmp_path):
+    """Creates a chunked (time, lat, lon) variable with some masked values."""
+    with Dataset(tmp_path / "chunked.nc", mode="w") as dataset:
+        for name, size in [("time", 5), ("lat", 4), ("lon", 7)]:
+            dataset.createDimension(name, size)
+        variable = dataset.createVariable("data", float32, ("time", "lat", "lon"),
+                                          chunksizes=(2, 2, 3), fill_value=-999.)
+        data = ma.masked_array(arange(5*4*7, dtype=float32).reshape(5, 4, 7))
+        data[1, 2, 3] = ma.masked
+        data[:, 0, 6] = ma.masked
+        variable[...] = data
+    with Dataset(tmp_path / "chunked.nc", mode="r") as dataset:
+        yield dataset.variables["data"]
+
+
+@pytest.mark.parametrize("axis", [0, 1, -1])
+def test_chunked_mean(chunked_variable, axis):
+    expected = ma.mean(chunked_variable[...], axis=axis)
+    result = chunked_mean(chunked_variable, axis)
+    assert_allclose(ma.filled(result, -1.), ma.filled(expected, -1.), rtol=1.e-6)
+    assert (ma.getmaskarray(result) == ma.getmaskarray(expected)).all()
+
+
+def test_zonal_mean_of_variable(chunked_variable):
+    expected = ma.mean(chunked_variable[...], axis=-1)
+    assert_allclose(zonal_mean(chunked_variable), expected, rtol=1.e-6)
+
+
+def reference_global_mean(data, latitude):
+    weights = latitude_weights(latitude)
+    return sum(mean(data, axis=-1)*weights, axis=-1)/sum(weights)
+
+
+@pytest.fixture(params=[(6, 9), (3, 6, 9)], ids=["2d", "3d"])
+def global_data(request):
+    latitude = linspace(-75., 75., request.param[-2])
+    data = default_rng(0).normal(250., 30., request.param)
+    return data, latitude
+
+
+@pytest.mark.parametrize("use_numba", [False, True], ids=["einsum", "numba"])
+def test_global_mean_unmasked(global_data, use_numba, monkeypatch):
+    if use_numba:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(maps, "njit", None)
+    data, latitude = global_data
+    expected = reference_global_mean(data, latitude)
+    assert_allclose(global_mean(data, latitude), expected, rtol=1.e-12)
+    assert_allclose(global_mean(ma.masked_array(data), weights=latitude_weights(latitude)),
+                    expected, rtol=1.e-12)
+
+
+@pytest.mark.parametrize("use_numba", [False, True], ids=["einsum", "numba"])
+def test_global_mean_masked(global_data, use_numba, monkeypatch):
+    if use_numba:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(maps, "njit", None)
+    data, latitude = global_data
+    masked = ma.masked_array(data.copy())
+    masked[..., 1, 2] = ma.masked
+    masked[..., 4, 0:3] = ma.masked
+
+    # Replacing the masked values with the mean of the rest of their row does not
+    # change the zonal means, so the unmasked paths must give the same result.
+    filled = ma.filled(masked, 0.)
+    row_means = ma.mean(masked, axis=-1)
+    mask = ma.getmaskarray(masked)
+    filled[mask] = (row_means[..., None]*(mask*1.))[mask]
+    assert_allclose(global_mean(masked, latitude), global_mean(filled, latitude), rtol=1.e-12)